@@ -1,12 +1,41 @@
 # app.py
+from collections import deque
+from contextlib import closing
+
 import streamlit as st 
 from core import (
     lookup_medical_db,
     is_valid_response,
-    to_traditional,
+    to_traditional_stream,
+    UnsafeReplyError,
     fallback_response
 )
-from utils import query_ollama_web, FALLBACK_HINT
+from utils import (
+    stream_ollama_web,
+    BackgroundStream,
+    start_after_first_token,
+    FALLBACK_HINT
+)
+
+MAX_HISTORY = 20  # 只保留最近幾筆問答，避免每次重新執行都要重畫全部紀錄
+
+@st.fragment
+def render_history():
+    """顯示問答紀錄；以 fragment 包起來，不必跟著其他元件一起重新執行"""
+    if st.session_state.history:
+        st.markdown("---")
+        st.subheader("📝 我的問答紀錄")
+        for idx, record in enumerate(reversed(st.session_state.history), 1):
+            with st.expander(f"問題 {idx}: {record['q']}"):
+                st.markdown(record["a"])
+
+def stream_reply(placeholder, tokens) -> str:
+    """在 placeholder 中逐句顯示模型回應；偵測到不合格內容時停止並回傳空字串"""
+    with placeholder.container():
+        try:
+            return st.write_stream(to_traditional_stream(tokens))
+        except UnsafeReplyError:
+            return ""
 
 def run_web():
     st.set_page_config(
@@ -21,7 +50,7 @@ def run_web():
 
     # 保持輸入歷史
     if "history" not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = deque(maxlen=MAX_HISTORY)
 
     user_input = st.text_area(
         "請描述您的症狀，例如：肚子痛，一直拉肚子",
@@ -41,28 +70,30 @@ def run_web():
                     st.success("✅ 查詢到常見症狀，以下是建議：")
                     st.text(reply)
                 else:
-                    reply = query_ollama_web(user_input)
-                    if not is_valid_response(reply):
-                        st.warning("⚠️ 回應可能不適合長輩，嘗試修正中...")
-                        reply = query_ollama_web(user_input + "\n" + FALLBACK_HINT)
+                    st.success("✅ 助理的建議如下：")
+                    placeholder = st.empty()
+                    # 推測式重試：第一次回應開始輸出後，就在背景先送出加上 fallback hint 的請求
+                    retry = BackgroundStream(
+                        lambda: stream_ollama_web(user_input + "\n" + FALLBACK_HINT)
+                    )
+                    with closing(retry):
+                        reply = stream_reply(
+                            placeholder,
+                            start_after_first_token(stream_ollama_web(user_input), retry)
+                        )
+                        if not is_valid_response(reply):
+                            st.warning("⚠️ 回應可能不適合長輩，嘗試修正中...")
+                            reply = stream_reply(placeholder, retry)
 
                     if not is_valid_response(reply):  # fallback
                         reply = fallback_response(user_input)
-
-                    reply = to_traditional(reply)
-                    st.success("✅ 助理的建議如下：")
-                    st.markdown(reply)
+                        placeholder.markdown(reply)
 
                 # 保存歷史紀錄
                 st.session_state.history.append({"q": user_input, "a": reply})
 
     # 顯示歷史紀錄
-    if st.session_state.history:
-        st.markdown("---")
-        st.subheader("📝 我的問答紀錄")
-        for idx, record in enumerate(reversed(st.session_state.history), 1):
-            with st.expander(f"問題 {idx}: {record['q']}"):
-                st.markdown(record["a"])
+    render_history()
 
     st.markdown("---")
     st.caption("© 2025 養生健康助理 — 提供溫暖的健康建議")
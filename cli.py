@@ -2,13 +2,22 @@
 import sys
 import time
 import logging
+from contextlib import closing
+from typing import Iterable
 from core import (
     lookup_medical_db,
     is_valid_response,
-    to_traditional,
+    to_traditional_stream,
+    UnsafeReplyError,
     fallback_response
 )
-from utils import build_cli_prompt, query_ollama_cli, FALLBACK_HINT
+from utils import (
+    build_cli_prompt,
+    stream_ollama_cli,
+    BackgroundStream,
+    start_after_first_token,
+    FALLBACK_HINT
+)
 
 # Logging 設定
 logger = logging.getLogger(__name__)
@@ -19,6 +28,19 @@ if not logger.handlers:
     logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+def stream_reply(tokens: Iterable[str]) -> str:
+    """逐句印出模型回應並回傳完整的繁體內容；偵測到不合格內容時停止並回傳空字串"""
+    sentences = []
+    try:
+        for sentence in to_traditional_stream(tokens):
+            print(sentence, end="", flush=True)
+            sentences.append(sentence)
+    except UnsafeReplyError:
+        print()
+        return ""
+    print()
+    return "".join(sentences).strip()
+
 def run_cli():
     print("=== 長照健康助理 (CLI) 已啟動 ===\n")
     print("小提醒：輸入 exit 可隨時離開。\n")
@@ -50,20 +72,23 @@ def run_cli():
         prompt = build_cli_prompt(question)
         print("\n🤖 模型處理中，請稍候...\n")
         time.sleep(0.5)
-        reply = query_ollama_cli(prompt)
+        # 推測式重試：第一次回應開始輸出後，就在背景先送出加上 fallback hint 的請求
+        retry = BackgroundStream(lambda: stream_ollama_cli(prompt + "\n" + FALLBACK_HINT))
+        with closing(retry):
+            print("🤖 回應：")
+            reply = stream_reply(start_after_first_token(stream_ollama_cli(prompt), retry))
 
-        # 品質檢查與 fallback
-        if not is_valid_response(reply):
-            logger.warning("回應不合格，將加入 fallback hint 重新請求")
-            print("⚠️ 偵測到不適合長輩的內容，嘗試重新修正...\n")
-            reply = query_ollama_cli(prompt + "\n" + FALLBACK_HINT)
+            # 品質檢查與 fallback
+            if not is_valid_response(reply):
+                logger.warning("回應不合格，改用已在背景進行的 fallback hint 請求")
+                print("\n⚠️ 偵測到不適合長輩的內容，嘗試重新修正...\n")
+                print("🤖 回應：")
+                reply = stream_reply(retry)
 
         if not is_valid_response(reply):  # 模型還是沒給好答案
             reply = fallback_response(question)
-
-        reply = to_traditional(reply)
-        print("🤖 回應：")
-        print(reply)
+            print("\n🤖 回應：")
+            print(reply)
         print("-" * 40)
 
 if __name__ == "__main__":
@@ -1,11 +1,23 @@
 # core.py
 import os
+import re
 import json
 import logging
-from typing import Optional, Dict, Any, List
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, Callable, Iterable, Iterator
 
 from opencc import OpenCC
 
+try:
+    import orjson
+except ImportError:  # 未安裝 orjson 時改用標準函式庫 json
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:  # 未安裝 pyahocorasick 時改用純 Python 字典樹
+    ahocorasick = None
+
 # ==============================
 # Logging 設定
 # ==============================
@@ -29,19 +41,26 @@ SYNONYMS: Dict[str, List[str]] = {
 # ==============================
 # 讀取醫療知識庫
 # ==============================
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 def load_medical_db() -> Dict[str, Any]:
     """安全讀取 JSON 知識庫，若失敗則回傳空字典"""
     if os.path.exists(DB_PATH):
         try:
-            with open(DB_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(DB_PATH, "rb") as f:
+                return _json_loads(f.read())
         except (json.JSONDecodeError, OSError) as e:
             logging.error(f"無法讀取醫療知識庫: {e}")
     else:
         logging.warning("找不到 medical_knowledge.json，將使用空白知識庫")
     return {}
 
-medical_db: Dict[str, Any] = load_medical_db()
+@lru_cache(maxsize=1)
+def get_medical_db() -> Dict[str, Any]:
+    """第一次查詢時才讀取並預先格式化知識庫，之後直接回傳同一份資料"""
+    db = load_medical_db()
+    preformat_medical_db(db)
+    return db
 
 def fallback_response(user_input: str) -> str:
     """
@@ -58,21 +77,62 @@ def fallback_response(user_input: str) -> str:
 # ==============================
 # OpenCC：簡轉繁
 # ==============================
-cc = OpenCC("s2t")
+@lru_cache(maxsize=1)
+def get_converter() -> OpenCC:
+    """第一次轉換時才載入 OpenCC 字典，避免拖慢啟動"""
+    return OpenCC("s2t")
+
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？\n])")
+
+@lru_cache(maxsize=1024)
+def _convert(text: str) -> str:
+    """以句子為單位呼叫 OpenCC；相同句子只轉換一次"""
+    if text.isascii():  # 純英數符號不需轉換
+        return text
+    return get_converter().convert(text)
 
 def to_traditional(text: str) -> str:
-    """將輸入轉換為繁體中文"""
-    return cc.convert(text)
+    """
+    將一整段文字轉換為繁體中文（例如寫入回應快取前的完整回應）。
+    與串流輸出（to_traditional_stream）一樣依句子切開轉換，共用同一份句子快取；
+    詞組不會跨越句尾標點，所以結果與整段一次轉換相同。
+    """
+    return "".join(_convert(sentence) for sentence in _SENTENCE_END_RE.split(text))
+
+# ==============================
+# 多字串比對（Aho–Corasick / regex）
+# ==============================
+def build_term_matcher(term_to_value: Dict[str, str]) -> Callable[[str], Iterator[str]]:
+    """
+    將多個關鍵詞預先編譯成比對器，之後只需掃描輸入一次。
+    有安裝 pyahocorasick 時使用 Aho–Corasick 自動機，否則使用預先編譯的 regex 選擇式。
+    Args:
+        term_to_value (dict): 關鍵詞 → 命中時回傳的值
+    Returns:
+        Callable: 傳入文字，依出現位置逐一產生命中關鍵詞對應的值
+    """
+    if not term_to_value:
+        return lambda text: iter(())
+
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for term, value in term_to_value.items():
+            automaton.add_word(term, value)
+        automaton.make_automaton()
+        return lambda text: (value for _, value in automaton.iter(text))
+
+    # 長詞優先，避免較短的同義詞搶先命中
+    pattern = re.compile("|".join(
+        re.escape(term) for term in sorted(term_to_value, key=len, reverse=True)
+    ))
+    return lambda text: (term_to_value[m.group()] for m in pattern.finditer(text))
 
 # ==============================
 # 偵測簡體字
 # ==============================
+# 實際的檢查併入下方 _INVALID_CONTENT_RE，與危險詞一起以單一 regex 掃描
 SIMPLIFIED_CHARS = set("后发为亿仅厉压妈属层厂广庆录觉")
 
-def contains_simplified_chinese(text: str) -> bool:
-    """檢查字串是否含簡體字"""
-    return any(c in SIMPLIFIED_CHARS for c in text)
-
 # ==============================
 # 回應內容品質檢查
 # ==============================
@@ -81,6 +141,13 @@ DANGER_WORDS = {
     "死亡", "截肢", "痙攣", "糖尿病", "腎病變", "慢性病", "病發", "惡化"
 }
 NONSENSE_WORDS = {"滴水", "肝膜病", "寄生處機", "胎婦與孕婦的危險"}
+BAD_WORDS = frozenset(DANGER_WORDS | NONSENSE_WORDS)
+# 危險詞、無意義詞與簡體字合併成單一 regex，一次掃描就能完成內容檢查；
+# 簡體字寫成單字元分支（而非字元類別）才能保留 re 的前綴字元最佳化
+_INVALID_CONTENT_RE = re.compile("|".join(
+    re.escape(term)
+    for term in sorted(BAD_WORDS | SIMPLIFIED_CHARS, key=len, reverse=True)
+))
 
 def is_valid_response(text: str, min_length: int = 50) -> bool:
     """
@@ -92,20 +159,80 @@ def is_valid_response(text: str, min_length: int = 50) -> bool:
     """
     if not text or not isinstance(text, str):
         return False
-    if any(w in text for w in DANGER_WORDS | NONSENSE_WORDS):
-        logging.warning("回應含有危險或無意義詞彙")
-        return False
-    if contains_simplified_chinese(text):
-        logging.warning("回應含有簡體字")
+    match = _INVALID_CONTENT_RE.search(text)
+    if match:
+        if match.group() in SIMPLIFIED_CHARS:
+            logging.warning("回應含有簡體字")
+        else:
+            logging.warning("回應含有危險或無意義詞彙")
         return False
     if len(text.strip()) < min_length:
         logging.warning("回應過短，可能無法幫助使用者")
         return False
     return True
 
+# ==============================
+# 串流回應：逐句轉繁體並檢查
+# ==============================
+class UnsafeReplyError(Exception):
+    """串流途中偵測到危險、無意義詞彙或簡體字"""
+
+def _checked_sentence(sentence: str) -> str:
+    """將一句轉成繁體，含不合格內容時丟出 UnsafeReplyError"""
+    converted = _convert(sentence)
+    match = _INVALID_CONTENT_RE.search(converted)
+    if match:
+        logging.warning(f"串流回應含有不合格內容「{match.group()}」，停止輸出")
+        raise UnsafeReplyError(match.group())
+    return converted
+
+def to_traditional_stream(tokens: Iterable[str]) -> Iterator[str]:
+    """
+    將模型的串流輸出逐句轉成繁體中文，檢查通過後才輸出。
+    - 累積到句尾標點（。！？或換行）才整句轉換，避免詞組被切在兩段之間
+      （例如「头」「发」分開轉換會得到「頭發」而不是「頭髮」）
+    - 某一句含不合格內容時不輸出該句，關閉上游串流並丟出 UnsafeReplyError
+    """
+    buffer = ""
+    try:
+        for token in tokens:
+            *sentences, buffer = _SENTENCE_END_RE.split(buffer + token)
+            for sentence in sentences:
+                yield _checked_sentence(sentence)
+        if buffer:
+            yield _checked_sentence(buffer)
+    finally:
+        close = getattr(tokens, "close", None)
+        if close is not None:  # 提早結束時中斷與模型的連線
+            close()
+
 # ==============================
 # 資料庫查詢（含同義詞）
 # ==============================
+def build_symptom_index(db: Dict[str, Any]) -> Dict[str, str]:
+    """
+    將 SYNONYMS（症狀 → 同義詞清單）反轉成「詞 → 知識庫鍵值」的平面索引。
+    Args:
+        db (dict): 醫療知識庫
+    Returns:
+        dict: 症狀名稱與同義詞對應到的知識庫鍵值
+    """
+    term_to_key: Dict[str, str] = {}
+    for key in db:
+        for term in [key] + SYNONYMS.get(key, []):
+            term_to_key.setdefault(term, key)
+    return term_to_key
+
+@lru_cache(maxsize=1)
+def get_symptom_index() -> Dict[str, str]:
+    """延遲建立的症狀反向索引"""
+    return build_symptom_index(get_medical_db())
+
+@lru_cache(maxsize=1)
+def get_symptom_matcher() -> Callable[[str], Iterator[str]]:
+    """延遲建立的症狀多字串比對器"""
+    return build_term_matcher(get_symptom_index())
+
 def lookup_medical_db(user_input: str) -> Optional[str]:
     """
     根據使用者輸入查詢知識庫，並組裝建議回應。
@@ -116,13 +243,17 @@ def lookup_medical_db(user_input: str) -> Optional[str]:
     """
     if not user_input:
         return None
+    return _lookup_cached(user_input.strip())
 
-    user_input = user_input.strip()
-    for key, entry in medical_db.items():
-        terms = [key] + SYNONYMS.get(key, [])
-        if any(term in user_input for term in terms):
-            return format_response(entry)
-    return None
+@lru_cache(maxsize=256)
+def _lookup_cached(user_input: str) -> Optional[str]:
+    """實際的知識庫查詢；相同輸入直接回傳快取結果"""
+    key = get_symptom_index().get(user_input)  # 輸入剛好是症狀或同義詞
+    if key is None:
+        key = next(get_symptom_matcher()(user_input), None)
+    if key is None:
+        return None
+    return get_medical_db()[key]["_formatted"]
 
 def format_response(entry: Dict[str, Any]) -> str:
     """
@@ -145,3 +276,8 @@ def format_response(entry: Dict[str, Any]) -> str:
     lines.append("4. 鼓勵的話：")
     lines.append(f"   - {entry.get('encouragement', '請多注意休息喔！')}")
     return "\n".join(lines)
+
+def preformat_medical_db(db: Dict[str, Any]) -> None:
+    """知識庫載入後只讀，預先把每筆資料格式化好，查詢時直接取用"""
+    for entry in db.values():
+        entry["_formatted"] = format_response(entry)
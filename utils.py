@@ -1,12 +1,46 @@
+import os
+import re
+import json
+import hashlib
 import logging
+import threading
 import requests
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from contextlib import closing
+from typing import Optional, Dict, Any, Callable, Iterator, Iterable, List
 from core import to_traditional, is_valid_response
 
+try:
+    import diskcache
+except ImportError:  # 未安裝 diskcache 時改用記憶體快取
+    diskcache = None
+
 # ===== Ollama API 設定 =====
-MODEL = "qwen:1.8b-chat"
+# 預設使用以 Modelfile 建立的 Q4_K_M 量化模型，可用環境變數 OLLAMA_MODEL 覆寫
+MODEL = os.getenv("OLLAMA_MODEL", "qwen-elder-q4")
 OLLAMA_URL_CLI = "http://localhost:11434/api/chat"
 OLLAMA_URL_WEB = "http://localhost:11434/api/generate"
+# 提示語要求的固定結尾；模型一寫完這句就結束串流，不再等後續的客套話
+REPLY_END = "如果還有其他不舒服，也可以再問我喔，我會陪著您 😊"
+# 比對在轉繁體之前進行，模型用簡體寫出結尾語時也要能停下
+REPLY_END_MARKERS = (REPLY_END, "如果还有其他不舒服，也可以再问我喔，我会陪着您 😊")
+_REPLY_END_TAIL = max(len(marker) for marker in REPLY_END_MARKERS)
+OLLAMA_OPTIONS = {
+    "num_predict": 220,
+    "num_ctx": 1024,
+    "num_thread": os.cpu_count(),
+    "temperature": 0.3,
+    "stop": ["\n\n\n"],
+}
+
+# ===== vLLM 設定（OpenAI 相容 API，支援 continuous batching）=====
+# 設定 USE_VLLM=1 時改走 vLLM；未設定則維持 Ollama
+USE_VLLM = os.getenv("USE_VLLM", "").lower() in ("1", "true", "yes")
+VLLM_URL = os.getenv("VLLM_URL", "http://localhost:8000/v1/chat/completions")
+if USE_VLLM:
+    MODEL = os.getenv("VLLM_MODEL", "Qwen/Qwen1.5-1.8B-Chat")
+    OLLAMA_URL_CLI = OLLAMA_URL_WEB = VLLM_URL
 
 # ===== Fallback Hint =====
 FALLBACK_HINT = (
@@ -14,6 +48,12 @@ FALLBACK_HINT = (
     "語氣溫和，針對年長者，務必使用正體中文。"
 )
 
+# ===== 回應快取設定 =====
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".ollama_cache")
+CACHE_SIZE_LIMIT = 256 * 1024 * 1024  # 256 MB
+MEMORY_CACHE_SIZE = 256
+CACHE_VERSION = 2  # 快取內容格式改變時遞增，讓舊的磁碟快取自動失效
+
 # ===== Logging 設定 =====
 logger = logging.getLogger(__name__)
 if not logger.handlers:
@@ -24,9 +64,10 @@ if not logger.handlers:
 logger.setLevel(logging.INFO)
 
 # ===== Prompt 建立函式 =====
-def build_cli_prompt(user_question: str) -> str:
-    """產生適合 CLI 的提示語"""
-    return f"""你是一位貼心的健康小幫手，專門幫助台灣的長輩理解身體小狀況。
+# 固定的指示放在最前面、使用者問題只接在最後，
+# 讓每次請求的前綴完全相同，Ollama / vLLM 才能重用前綴的 KV cache。
+# 修改時請勿在這兩段文字中插入任何會隨請求變動的內容。
+CLI_PROMPT_PREFIX = """你是一位貼心的健康小幫手，專門幫助台灣的長輩理解身體小狀況。
 請針對以下提問，用溫和、簡單、白話的語氣說明，千萬不要提到癌症、腎衰竭、死亡等詞語。
 請使用正體中文。
 
@@ -39,70 +80,349 @@ def build_cli_prompt(user_question: str) -> str:
 以「您好～」開頭，「如果還有其他不舒服，也可以再問我喔，我會陪著您 😊」結尾。
 
 問題如下：
-「{user_question}」
 """
 
-def build_web_prompt(user_input: str) -> str:
-    """產生適合 Web 的提示語"""
-    return f"""你是一位貼心的中文健康助理，請用溫暖、親切、容易懂的繁體中文，幫助長者理解他們的身體狀況。
+WEB_PROMPT_PREFIX = """你是一位貼心的中文健康助理，請用溫暖、親切、容易懂的繁體中文，幫助長者理解他們的身體狀況。
 請避免使用嚇人的醫學術語，並保持語氣溫和。
 請以「您好～」開頭，以「如果還有其他不舒服，也可以再問我喔，我會陪著您 😊」結尾。
 
 問題：
-「{user_input}」
 """
 
-# ===== 通用 POST 請求 =====
-def _post_request(url: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    """通用的 POST 請求處理，避免重複程式碼"""
+def build_cli_prompt(user_question: str) -> str:
+    """產生適合 CLI 的提示語"""
+    return f"{CLI_PROMPT_PREFIX}「{user_question}」\n"
+
+def build_web_prompt(user_input: str) -> str:
+    """產生適合 Web 的提示語"""
+    return f"{WEB_PROMPT_PREFIX}「{user_input}」\n"
+
+# ===== 共用 HTTP 連線 =====
+# 重複使用與 Ollama 的 TCP 連線，避免每次請求都重新建立連線
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+_SESSION.headers.update({"Connection": "keep-alive"})
+
+# ===== 串流 POST 請求 =====
+def _find_reply_end(text: str) -> int:
+    """回傳結尾語（繁體或簡體）在 text 中的結束位置，找不到時回傳 -1"""
+    for marker in REPLY_END_MARKERS:
+        start = text.find(marker)
+        if start != -1:
+            return start + len(marker)
+    return -1
+
+def _stream_request(
+    url: str,
+    payload: Dict[str, Any],
+    extract: Callable[[Dict[str, Any]], str],
+    on_response: Optional[Callable[[requests.Response], None]] = None,
+) -> Iterator[str]:
+    """
+    以串流方式送出 POST 請求，逐段產生模型輸出的文字。
+    on_response 會在收到回應標頭後取得 response，讓其他執行緒能關閉連線中斷請求。
+    """
+    tail = ""  # 前一段文字的結尾，用來偵測被切在兩段之間的結尾語
     try:
         logger.info(f"向 Ollama 請求: {url}")
-        r = requests.post(url, json=payload, timeout=30)
-        r.raise_for_status()
-        return r.json()
+        with _SESSION.post(url, json=payload, stream=True, timeout=(3, 60)) as r:
+            r.raise_for_status()
+            if on_response is not None:
+                on_response(r)
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                if line.startswith(b"data:"):  # vLLM 使用 SSE 格式
+                    line = line[5:].strip()
+                    if line == b"[DONE]":
+                        break
+                chunk = json.loads(line)
+                token = extract(chunk)
+                if token:
+                    window = tail + token
+                    end = _find_reply_end(window)
+                    if end != -1:
+                        # 輸出到結尾語為止並關閉連線，模型端會停止生成
+                        yield token[:end - len(tail)]
+                        break
+                    yield token
+                    tail = window[-_REPLY_END_TAIL:]
+                if chunk.get("done"):
+                    break
     except requests.exceptions.RequestException as e:
         logger.error(f"Ollama API 錯誤: {e}")
-        return None
+    except ValueError as e:
+        logger.error(f"Ollama 串流格式錯誤: {e}")
+
+# ===== 回應快取 =====
+class _LRUCache(OrderedDict):
+    """未安裝 diskcache 時使用的記憶體 LRU 快取（各 Streamlit session 執行緒共用，需加鎖）"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return self[key]
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self[key] = value
+            self.move_to_end(key)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+if diskcache is not None:
+    _response_cache = diskcache.Cache(CACHE_DIR, size_limit=CACHE_SIZE_LIMIT)
+else:
+    _response_cache = _LRUCache(MEMORY_CACHE_SIZE)
+
+def _cache_key(url: str, prompt: str) -> str:
+    """以模型、端點與正規化後的提示語產生快取鍵值"""
+    normalized = re.sub(r"\s+", " ", prompt.strip().lower())
+    raw_key = f"{CACHE_VERSION}\0{MODEL}\0{url}\0{normalized}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+# ===== single-flight =====
+# Streamlit 的每個 session 各自在執行緒中執行；相同的提示語同時只送出一次請求，
+# 其餘 session 直接訂閱同一個串流，不必等它結束。
+class ReplyStream:
+    """stream_ollama_* 回傳的串流：可迭代取得文字，close() 表示不再需要這個回應"""
+
+    def __init__(
+        self,
+        tokens: Iterable[str],
+        on_close: Optional[Callable[[], None]] = None,
+        from_cache: bool = False,
+    ):
+        self._tokens = tokens
+        self._on_close = on_close
+        self._closed = False
+        self.from_cache = from_cache  # 回應直接來自快取，沒有送出模型請求
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            yield from self._tokens
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._on_close is not None:
+            self._on_close()
 
-# ===== CLI 模式呼叫 =====
-def query_ollama_cli(prompt: str, use_fallback: bool = False) -> str:
+class _SharedStream:
+    """
+    在背景執行緒讀取一個模型請求，並把文字分送給所有訂閱者。
+    晚加入的訂閱者會先收到已產生的部分再接著即時串流；
+    最後一個訂閱者離開時立即關閉連線，模型端就會停止生成。
+    """
+
+    def __init__(self, key: str, url: str, payload: Dict[str, Any], extract: Callable[[Dict[str, Any]], str]):
+        self._key = key
+        self._url = url
+        self._payload = payload
+        self._extract = extract
+        self._tokens: List[str] = []
+        self._subscribers = 0
+        self._finished = False
+        self._cancelled = False
+        self._response: Optional[requests.Response] = None
+        self._cond = threading.Condition()
+
+    def start(self) -> None:
+        threading.Thread(target=self._pump, name="ollama-stream", daemon=True).start()
+
+    def subscribe(self) -> Optional[ReplyStream]:
+        """加入訂閱；請求已被取消時回傳 None"""
+        with self._cond:
+            if self._cancelled:
+                return None
+            self._subscribers += 1
+        return ReplyStream(self._follow(), on_close=self._unsubscribe)
+
+    def _follow(self) -> Iterator[str]:
+        index = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._tokens) > index or self._finished)
+                new = self._tokens[index:]
+                finished = self._finished
+            if not new and finished:
+                return
+            index += len(new)
+            yield from new
+
+    def _unsubscribe(self) -> None:
+        with self._cond:
+            self._subscribers -= 1
+            if self._subscribers > 0 or self._finished:
+                return
+            self._cancelled = True
+            response = self._response
+        self._forget()
+        if response is not None:
+            logger.info("已無 session 需要這個回應，中斷模型請求")
+            response.close()
+
+    def _set_response(self, response: requests.Response) -> None:
+        with self._cond:
+            self._response = response
+            cancelled = self._cancelled
+        if cancelled:  # 回應標頭到達前所有訂閱者就已離開
+            response.close()
+
+    def _forget(self) -> None:
+        with _inflight_lock:
+            if _inflight.get(self._key) is self:
+                del _inflight[self._key]
+
+    def _pump(self) -> None:
+        completed = False
+        try:
+            for token in _stream_request(self._url, self._payload, self._extract, self._set_response):
+                with self._cond:
+                    if self._cancelled:
+                        break
+                    self._tokens.append(token)
+                    self._cond.notify_all()
+            else:
+                completed = not self._cancelled
+            if completed:
+                # 與介面相同，以轉成繁體後的內容檢查，並存入繁體版本
+                answer = to_traditional("".join(self._tokens).strip())
+                if is_valid_response(answer):
+                    _response_cache.set(self._key, answer)
+        except Exception as e:
+            if not self._cancelled:
+                logger.error(f"串流請求失敗: {e}")
+        finally:
+            self._forget()
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+_inflight: Dict[str, _SharedStream] = {}
+_inflight_lock = threading.Lock()
+
+def _open_stream(
+    url: str,
+    payload: Dict[str, Any],
+    prompt: str,
+    extract: Callable[[Dict[str, Any]], str],
+) -> ReplyStream:
+    """
+    先查快取，未命中才向 Ollama 串流請求（呼叫時即送出）；只有合格的回應會被寫入快取。
+    相同提示語已有請求進行中時，直接訂閱它的串流。
+    """
+    key = _cache_key(url, prompt)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        logger.info("命中回應快取，略過模型請求")
+        return ReplyStream([cached], from_cache=True)
+
+    with _inflight_lock:
+        shared = _inflight.get(key)
+        stream = shared.subscribe() if shared is not None else None
+        if stream is not None:
+            logger.info("相同問題正在處理中，共用進行中的串流")
+            return stream
+        shared = _SharedStream(key, url, payload, extract)
+        _inflight[key] = shared
+        stream = shared.subscribe()
+    shared.start()
+    return stream
+
+def _openai_delta(chunk: Dict[str, Any]) -> str:
+    """取出 OpenAI 相容串流片段中的文字"""
+    choices = chunk.get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or ""
+
+def _stream_vllm(url: str, prompt: str) -> ReplyStream:
+    """透過 vLLM 的 chat completions 端點串流回應"""
     payload = {
         "model": MODEL,
         "messages": [{"role": "user", "content": prompt}],
-        "stream": False
+        "stream": True,
+        "max_tokens": OLLAMA_OPTIONS["num_predict"],
+        "temperature": OLLAMA_OPTIONS["temperature"],
+        "stop": OLLAMA_OPTIONS["stop"],
     }
-    response = _post_request(OLLAMA_URL_CLI, payload)
-    if response:
-        answer = response.get("message", {}).get("content", "").strip()
-        if is_valid_response(answer):
-            return to_traditional(answer)
-        if not use_fallback:
-            logger.warning("回應不符合標準，嘗試使用 fallback hint")
-            modified_prompt = prompt + "\n\n" + FALLBACK_HINT
-            return query_ollama_cli(modified_prompt, use_fallback=True)
-        else:
-            logger.error("fallback 仍不合格，回傳預設訊息")
-            return "抱歉，我目前無法給出合適的建議，請諮詢醫生。"
-    return "⚠️ 系統錯誤，請稍後再試。"
-
-# ===== Web 模式呼叫 =====
-def query_ollama_web(user_input: str, use_fallback: bool = False) -> str:
+    return _open_stream(url, payload, prompt, _openai_delta)
+
+def stream_ollama_cli(prompt: str) -> ReplyStream:
+    """CLI 模式：逐段產生 /api/chat 的回應文字"""
+    if USE_VLLM:
+        return _stream_vllm(OLLAMA_URL_CLI, prompt)
+    payload = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+        "options": OLLAMA_OPTIONS,
+    }
+    return _open_stream(
+        OLLAMA_URL_CLI, payload, prompt,
+        lambda chunk: chunk.get("message", {}).get("content", "")
+    )
+
+def stream_ollama_web(user_input: str) -> ReplyStream:
+    """Web 模式：逐段產生 /api/generate 的回應文字"""
     prompt = build_web_prompt(user_input)
+    if USE_VLLM:
+        return _stream_vllm(OLLAMA_URL_WEB, prompt)
     payload = {
         "model": MODEL,
         "prompt": prompt,
-        "stream": False,
+        "stream": True,
+        "options": OLLAMA_OPTIONS,
     }
-    response = _post_request(OLLAMA_URL_WEB, payload)
-    if response:
-        answer = response.get("response", "").strip()
-        if is_valid_response(answer):
-            return to_traditional(answer)
-        if not use_fallback:
-            logger.warning("回應不符合標準，嘗試使用 fallback hint")
-            modified_input = user_input + "。" + FALLBACK_HINT
-            return query_ollama_web(modified_input, use_fallback=True)
-        else:
-            logger.error("fallback 仍不合格，回傳預設訊息")
-            return "抱歉，我目前無法給出合適的建議，請諮詢醫生。"
-    return "⚠️ 系統錯誤，請稍後再試。"
+    return _open_stream(
+        OLLAMA_URL_WEB, payload, prompt,
+        lambda chunk: chunk.get("response", "")
+    )
+
+# ===== 推測式 fallback 請求 =====
+class BackgroundStream:
+    """
+    延後送出的請求，讓加上 fallback hint 的重試與第一次請求重疊進行。
+    start() 時才送出（請求在背景執行緒中串流）；迭代時依序取出收到的文字，
+    close() 會關閉連線，立即中斷請求。
+    """
+
+    def __init__(self, open_stream: Callable[[], ReplyStream]):
+        self._open_stream = open_stream
+        self._stream: Optional[ReplyStream] = None
+        self._closed = False
+
+    def start(self) -> None:
+        if self._stream is None and not self._closed:
+            self._stream = self._open_stream()
+
+    def __iter__(self) -> Iterator[str]:
+        self.start()
+        if self._stream is not None:
+            yield from self._stream
+
+    def close(self) -> None:
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+def start_after_first_token(tokens: ReplyStream, background: BackgroundStream) -> Iterator[str]:
+    """
+    原樣轉送 tokens，收到第一段文字後才啟動背景請求。
+    Ollama 預設一次只處理一個請求，這樣能確保原始請求先排進佇列，不會被重試拖慢；
+    回應直接來自快取時則不啟動，避免多送一次模型請求。
+    """
+    with closing(tokens):
+        for token in tokens:
+            if not tokens.from_cache:
+                background.start()
+            yield token